@@ -2,19 +2,29 @@
 
 # downloads and exports data on all substances from psychonautwiki and tripsit factsheets, combining to form master list with standardized format
 # prioritizes psychonautwiki ROA info (dose/duration) over tripsit factsheets
-# pip3 install beautifulsoup4 requests python-graphql-client
+# pip3 install orjson selectolax requests
 
 import argparse
 import requests
-from bs4 import BeautifulSoup
-from time import time, sleep
-from python_graphql_client import GraphqlClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from selectolax.lexbor import LexborHTMLParser
+from time import time
 import json
+import orjson
 import os
 import re
 import traceback
 import sys
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 parser = argparse.ArgumentParser(
     description="Scrape PsychonautWiki and TripSit data into unified dataset"
 )
@@ -22,6 +32,19 @@ parser.add_argument("output", type=str, nargs="?", help="Optional output file")
 parser.add_argument(
     "-q", "--quiet", action="store_true", default=False, help="Quieter output"
 )
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=positive_int,
+    default=8,
+    help="Number of PsychonautWiki pages to scrape concurrently",
+)
+parser.add_argument(
+    "--offline",
+    action="store_true",
+    default=False,
+    help="Only use cached PsychonautWiki data, without checking for new substances",
+)
 args = parser.parse_args()
 
 headers = {
@@ -34,24 +57,78 @@ headers = {
 
 ts_api_url = "https://tripbot.tripsit.me/api/tripsit/getAllDrugs"
 ps_api_url = "https://api.psychonautwiki.org"
-ps_client = GraphqlClient(endpoint=ps_api_url)
+# (connect, read) seconds, so stalled requests are retried instead of hanging a worker
+request_timeout = (10, 60)
+
+# share keep-alive connections across requests (and scrape threads)
+session = requests.Session()
+session.headers.update(headers)
+adapter = HTTPAdapter(
+    pool_connections=args.jobs,
+    pool_maxsize=args.jobs,
+    max_retries=Retry(
+        total=3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        backoff_factor=1,
+        # PS API queries are sent as POST but are safe to repeat
+        allowed_methods=["GET", "POST"],
+    ),
+)
+session.mount("https://", adapter)
 
 
-def substance_name_match(name, substance):
-    """check if name matches any value in keys we care about"""
-    lower_name = name.lower()
-    return any(
-        [
-            lower_name == substance[key].lower()
-            for key in ["name", "pretty_name"]
-            if key in substance
-        ]
-        + [lower_name == alias.lower() for alias in substance.get("aliases", [])]
+def ps_execute(query):
+    """run GraphQL query against PS API, returning its data"""
+    response = session.post(
+        ps_api_url, json={"query": query}, timeout=request_timeout
     )
-
-
-def find_substance_in_data(data, name):
-    return next((s for s in data if substance_name_match(name, s)), None)
+    # query errors come back as HTTP 400 with an errors body, so read it first
+    try:
+        body = response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise
+
+    errors = body.get("errors")
+    if errors:
+        if body.get("data") is None:
+            raise RuntimeError(f"PS API query failed: {errors}")
+        print(f"PS API query returned partial errors: {errors}", file=sys.stderr)
+    response.raise_for_status()
+    return body["data"]
+
+
+def substance_names(substance):
+    """lowercase values of keys we care about for matching names"""
+    for key in ("name", "pretty_name"):
+        if key in substance:
+            yield substance[key].lower()
+    for alias in substance.get("aliases", ()):
+        yield alias.lower()
+
+
+def cache_substance_names(data):
+    """store lowercase names of each substance once, under _names_lc"""
+    for substance in data:
+        # names often repeat as aliases, keep each only once
+        substance["_names_lc"] = frozenset(substance_names(substance))
+
+
+def build_substance_index(data):
+    """map each lowercase name and alias to its substances, in data order"""
+    index = {}
+    for substance in data:
+        for name in substance["_names_lc"]:
+            index.setdefault(name, []).append(substance)
+    return index
+
+
+def take_substance_from_index(index, name, seen):
+    """take first substance matching name whose id isn't in seen, marking it seen"""
+    substance = next((s for s in index.get(name, []) if id(s) not in seen), None)
+    if substance is not None:
+        seen.add(id(substance))
+    return substance
 
 
 roa_name_aliases = {
@@ -75,7 +152,11 @@ def roa_matches_name(roa, name):
 
 
 ts_dose_order = ["Threshold", "Light", "Common", "Strong", "Heavy"]
-ts_combo_ignore = ["benzos"]  # duplicate
+# roa name followed by its bioavailability, e.g. "Oral: 60-70%"
+ts_bioavailability_re = re.compile(r"([a-zA-Z\/]+)[.:\s]+([0-9\.%\s\+/\-]+)")
+ts_combo_ignore = frozenset(["benzos"])  # duplicate
+# combo categories missing from ts_combo_transformations, reported once each
+ts_unknown_combos = set()
 # prettify names in interaction list
 ts_combo_transformations = {
     "lsd": "LSD",
@@ -107,51 +188,167 @@ ts_combo_transformations = {
     "ssris": "SSRIs",
 }
 
-ts_response = requests.get(ts_api_url)
+ts_response = session.get(ts_api_url, timeout=request_timeout)
 ts_data = ts_response.json()["data"][0]
 
 ts_substances_data = list(ts_data.values())
+cache_substance_names(ts_substances_data)
 
 
 # get psychonautwiki data
 
 
+pw_leading_quote_re = re.compile(r'^"')
+pw_trailing_quote_re = re.compile(r'"$')
+pw_reference_re = re.compile(r'"?\[\d*\]$')
+pw_more_names_re = re.compile(r"\s*More names\.$")
+pw_trailing_period_re = re.compile(r"\.$")
+
+
 def pw_clean_common_name(name):
-    name = re.sub(r'^"', "", name)
-    name = re.sub(r'"$', "", name)
-    name = re.sub(r'"?\[\d*\]$', "", name)
-    name = re.sub(r"\s*More names\.$", "", name)
-    name = re.sub(r"\.$", "", name)
+    name = pw_leading_quote_re.sub("", name)
+    name = pw_trailing_quote_re.sub("", name)
+    name = pw_reference_re.sub("", name)
+    name = pw_more_names_re.sub("", name)
+    name = pw_trailing_period_re.sub("", name)
     return name.strip()
 
 
-def pw_should_skip(name, soup):
-    return (
-        not name
-        or name.startswith("Experience:")
-        or len(soup.find_all(text="Routes of Administration")) == 0
+def pw_find_text(tree, selector, text):
+    """find first node matching selector whose own text is exactly text"""
+    return next(
+        (node for node in tree.css(selector) if node.text(deep=False) == text), None
     )
 
 
-def try_three_times(func):
-    attempt = 0
-    while attempt < 3:
-        try:
-            return func()
-        except Exception as e:
-            print()
-            print(e, file=sys.stderr)
-            attempt += 1
-            sleep(1)
+def pw_scrape_page(url):
+    """fetch and parse substance page, returning (name, has_roas, common_names)"""
+    substance_req = session.get(url, timeout=request_timeout)
+    # psychonautwiki declares its charset, so let requests decode the page
+    substance_tree = LexborHTMLParser(substance_req.text)
+
+    heading = substance_tree.css_first("h1#firstHeading")
+    name = heading.text() if heading else None
+    # pages with a "Routes of Administration" table have ROA row headers
+    has_roas = substance_tree.css_first("th.ROARowHeader") is not None
+
+    # get aliases text
+    common_names_td = pw_find_text(substance_tree, "th", "Common names")
+    while common_names_td is not None and common_names_td.tag != "td":
+        common_names_td = common_names_td.next
+    common_names = (
+        common_names_td.text().split(", ") if common_names_td is not None else []
+    )
+
+    return name, has_roas, common_names
+
+
+def pw_should_skip(name, has_roas):
+    return not name or name.startswith("Experience:") or not has_roas
+
 
+pw_query_batch_size = 25
+pw_substance_fields = """
+fragment Fields on Substance {
+    name
+    commonNames
+    class {
+        chemical
+        psychoactive
+    }
+    tolerance {
+        full
+        half
+        zero
+    }
+    toxicity
+    addictionPotential
+    crossTolerances
+    roas {
+        name
+        dose {
+            units
+            threshold
+            heavy
+            common { min max }
+            light { min max }
+            strong { min max }
+        }
+        duration {
+            afterglow { min max units }
+            comeup { min max units }
+            duration { min max units }
+            offset { min max units }
+            onset { min max units }
+            peak { min max units }
+            total { min max units }
+        }
+    }
+}
+"""
 
-pw_substance_data = []
 
-if os.path.exists("_cached_pw_substances.json"):
-    with open("_cached_pw_substances.json") as f:
-        pw_substance_data = json.load(f)
+def pw_query_substances(names):
+    """query PS API for several substances in one request, keyed by name"""
+    # alias each selection so results can be matched back to their names
+    selections = "\n".join(
+        f"s{i}: substances(query: {json.dumps(name)}) {{ ...Fields }}"
+        for i, name in enumerate(names)
+    )
+    query = "{\n%s\n}\n%s" % (selections, pw_substance_fields)
+
+    data = ps_execute(query)
+    # selections that errored come back as null, leave them out so they're retried
+    return {
+        name: data[f"s{i}"]
+        for i, name in enumerate(names)
+        if data.get(f"s{i}") is not None
+    }
 
-if not len(pw_substance_data):
+
+pw_cache_filename = "_cached_pw_substances.json"
+# scraped substances are appended here as they finish, then compacted into the cache
+pw_cache_journal_filename = "_cached_pw_substances.jsonl"
+
+
+def pw_load_cache():
+    """load previously scraped substances, keyed by url"""
+    cache = {}
+    if os.path.exists(pw_cache_filename):
+        with open(pw_cache_filename, "rb") as f:
+            for substance in orjson.loads(f.read()):
+                cache[substance["url"]] = substance
+
+    # pick up substances from a run that ended before compacting
+    if os.path.exists(pw_cache_journal_filename):
+        with open(pw_cache_journal_filename, "rb") as f:
+            for line in f:
+                try:
+                    substance = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # partially written last line
+                    break
+                cache[substance["url"]] = substance
+    return cache
+
+
+def pw_compact_cache(cache):
+    # write to a temp file first so an interrupted write can't truncate the cache
+    tmp_filename = f"{pw_cache_filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(orjson.dumps(list(cache.values()), option=orjson.OPT_INDENT_2))
+    os.replace(tmp_filename, pw_cache_filename)
+    if os.path.exists(pw_cache_journal_filename):
+        os.remove(pw_cache_journal_filename)
+
+
+pw_cache = pw_load_cache()
+# appending after a partially written line would corrupt the next record
+if os.path.exists(pw_cache_journal_filename):
+    pw_compact_cache(pw_cache)
+
+pw_pending_substances = []
+if not args.offline:
     pw_substance_urls_query = """
     {
         substances(limit: 11000) {
@@ -161,201 +358,158 @@ if not len(pw_substance_data):
     }
     """
 
-    pw_substance_urls_data = try_three_times(
-        lambda: ps_client.execute(query=pw_substance_urls_query)["data"]["substances"]
-    )
-
-    for idx, substance in enumerate(pw_substance_urls_data):
+    pw_substance_urls_data = ps_execute(pw_substance_urls_query)["substances"]
+
+    # only scrape substances that aren't cached from a previous run
+    pw_pending_substances = [
+        substance
+        for substance in pw_substance_urls_data
+        if substance["url"] not in pw_cache
+    ]
+
+if len(pw_pending_substances):
+    # query PS API for more data on all substances, several per request
+    pw_api_data = {}
+    pw_substance_names = [substance["name"] for substance in pw_pending_substances]
+    pw_name_batches = [
+        pw_substance_names[i : i + pw_query_batch_size]
+        for i in range(0, len(pw_substance_names), pw_query_batch_size)
+    ]
+
+    def scrape_substance(idx, substance):
+        name = substance["name"]
+        url = substance["url"]
+        # cached so later runs don't check skipped substances again
+        skipped = {"url": url, "skipped": True}
         try:
-            url = substance["url"]
-            substance_req = requests.get(url, headers)
-            substance_soup = BeautifulSoup(substance_req.content, "html.parser")
+            # PS API data for substance was fetched up front in batches
+            if substance["name"] not in pw_api_data:
+                # query for it errored, don't cache so the next run retries it
+                print(f"No PS API data for {name}, skipping for now", file=sys.stderr)
+                return None
+
+            data = pw_api_data[substance["name"]]
+            if len(data) == 0:
+                return skipped
+            elif len(data) > 1:
+                # should never happen?
+                print(f"{name} has more than one dataset... investigate why")
 
-            name = getattr(substance_soup.find("h1", id="firstHeading"), "text", None)
-            if pw_should_skip(name, substance_soup):
+            data = data[0]
+            if "name" in data:
+                name = data.pop("name")
+            api_common_names = data.pop("commonNames", None)
+
+            if data["roas"] and api_common_names:
+                # API has everything we need, no need to fetch and parse the page
+                has_roas = True
+                common_names_list = api_common_names
+            else:
+                name, has_roas, common_names_list = pw_scrape_page(url)
+
+            if pw_should_skip(name, has_roas):
                 if args.quiet:
                     print("x", end="")
                     sys.stdout.flush()
                 else:
                     print(
-                        f"Skipping {name} at {url} ({idx + 1} / {len(pw_substance_urls_data)})"
+                        f"Skipping {name} at {url} ({idx + 1} / {len(pw_pending_substances)})"
                     )
-                continue
-
-            # get aliases text
-            common_names_str = substance_soup.find_all(text="Common names")
+                return skipped
 
-            cleaned_common_names = (
-                set(
-                    map(
-                        pw_clean_common_name,
-                        common_names_str[0]
-                        .parent.find_next_sibling("td")
-                        .text.split(", "),
-                    )
-                )
-                if len(common_names_str) > 0
-                else set()
-            )
+            cleaned_common_names = set(map(pw_clean_common_name, common_names_list))
             cleaned_common_names.add(substance["name"])
             # don't include name in list of other common names
             common_names = sorted(filter(lambda n: n != name, cleaned_common_names))
 
-            # scrape ROAs from page
-
-            def get_data_starting_at_row(curr_row):
-                rows = []
-                while curr_row.find("th", {"class": "ROARowHeader"}):
-                    row = {}
-                    row["name"] = (
-                        curr_row.find("th", {"class": "ROARowHeader"}).find("a").text
-                    )
-
-                    row_values = curr_row.find("td", {"class": "RowValues"})
-
-                    row_value_text = row_values.find_all(text=True, recursive=False)
-                    if len(row_value_text):
-                        row["value"] = "".join(row_value_text).strip()
-                    else:
-                        row["value"] = None
-
-                    row_note = row_values.find("span")
-                    if row_note:
-                        row["note"] = re.sub(r"\s*\[\d*\]$", "", row_note.text).strip()
-
-                    rows.append(row)
-
-                    curr_row = curr_row.find_next("tr")
-                return rows, curr_row
-
-            # query PS API for more data on substance
-
-            query = (
-                """
-                {
-                    substances(query: "%s") {
-                        name
-                        class {
-                            chemical
-                            psychoactive
-                        }
-                        tolerance {
-                            full
-                            half
-                            zero
-                        }
-                        toxicity
-                        addictionPotential
-                        crossTolerances
-                        roas {
-                            name
-                            dose {
-                units
-                threshold
-                heavy
-                common { min max }
-                light { min max }
-                strong { min max }
-            }
-
-            duration {
-                afterglow { min max units }
-                comeup { min max units }
-                duration { min max units }
-                offset { min max units }
-                onset { min max units }
-                peak { min max units }
-                total { min max units }
-            }
-
-                        }
-                    }
-                }
-            """
-                % substance["name"]
-            )
-
-
-
-            data = try_three_times(
-                lambda: ps_client.execute(query=query)["data"]["substances"]
-            )
-            if len(data) == 0:
-                continue
-            elif len(data) > 1:
-                # should never happen?
-                print(f"{name} has more than one dataset... investigate why")
-
-            data = data[0]
-            if "name" in data:
-                data.pop("name")
-
-
             roas = []
             roas = data["roas"]
 
-            pw_substance_data.append(
-                {
-                    "url": url,
-                    "name": name,
-                    "aliases": common_names,
-                    "data": data,
-                    "roas": roas
-                }
-            )
-
-            
-
             if args.quiet:
                 print(".", end="")
                 sys.stdout.flush()
             else:
                 print(
-                    f"Done with {name} [{len(roas)} ROA(s)] ({idx + 1} / {len(pw_substance_urls_data)})"
+                    f"Done with {name} [{len(roas)} ROA(s)] ({idx + 1} / {len(pw_pending_substances)})"
                 )
 
-        except KeyboardInterrupt:
-            print("\nScrape canceled")
-            exit(0)
-        except:
+            return {
+                "url": url,
+                "name": name,
+                "aliases": common_names,
+                "data": data,
+                "roas": roas,
+            }
+        except Exception:
             print(f"{name} failed:", file=sys.stderr)
-            print(traceback.format_exc(), file=sys.stderr)
-            exit(1)
+            raise
+
+    def cancel_pending(executor, futures):
+        """cancel futures that haven't started (shutdown's cancel_futures needs 3.9)"""
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    # network bound, so query and fetch several at once while keeping original order
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    futures = []
+    try:
+        futures = [
+            executor.submit(pw_query_substances, batch) for batch in pw_name_batches
+        ]
+        for future in futures:
+            pw_api_data.update(future.result())
+
+        futures = [
+            executor.submit(scrape_substance, idx, substance)
+            for idx, substance in enumerate(pw_pending_substances)
+        ]
+        with open(pw_cache_journal_filename, "ab") as journal:
+            for future in futures:
+                pw_substance = future.result()
+                if pw_substance is None:
+                    continue
+                pw_cache[pw_substance["url"]] = pw_substance
+                journal.write(orjson.dumps(pw_substance) + b"\n")
+                journal.flush()
+    except KeyboardInterrupt:
+        cancel_pending(executor, futures)
+        print("\nScrape canceled")
+        exit(0)
+    except Exception:
+        cancel_pending(executor, futures)
+        print(traceback.format_exc(), file=sys.stderr)
+        exit(1)
+    finally:
+        pw_compact_cache(pw_cache)
+    executor.shutdown()
 
     if args.quiet:
         print()
 
-    # TODO: add option switch for this
-    # with open(f"_cached_pw_substances.json", "w") as f:
-    #     f.write(json.dumps(pw_substance_data, indent=2))
+pw_substance_data = [
+    substance for substance in pw_cache.values() if not substance.get("skipped")
+]
+cache_substance_names(pw_substance_data)
 
 # combine tripsit and psychonautwiki data
 
 
 all_substance_names = sorted(
-    set(
-        list(map(lambda s: s.get("name", "").lower(), pw_substance_data))
-        + list(map(lambda s: s.get("name", "").lower(), ts_substances_data))
-    )
+    {s.get("name", "").lower() for s in pw_substance_data}
+    | {s.get("name", "").lower() for s in ts_substances_data}
 )
 substance_data = []
 
+pw_index = build_substance_index(pw_substance_data)
+ts_index = build_substance_index(ts_substances_data)
+# ids of substances already merged, to get rid of duplicates in final output
+seen_substance_ids = set()
+
 for name in all_substance_names:
-    # find PW substance
-    pw_substance = find_substance_in_data(pw_substance_data, name)
-    # remove to get rid of duplicates in final output
-    if pw_substance:
-        pw_substance_data.remove(pw_substance)
-    else:
-        pw_substance = {}
-
-    # find TS substance
-    ts_substance = find_substance_in_data(ts_substances_data, name)
-    # remove to get rid of duplicates in final output
-    if ts_substance:
-        ts_substances_data.remove(ts_substance)
-    else:
-        ts_substance = {}
+    # find PW and TS substances
+    pw_substance = take_substance_from_index(pw_index, name, seen_substance_ids) or {}
+    ts_substance = take_substance_from_index(ts_index, name, seen_substance_ids) or {}
 
     # if no substance found in either dataset, skip
     if not pw_substance and not ts_substance:
@@ -406,9 +560,7 @@ for name in all_substance_names:
     ts_bioavailability_str = ts_properties.get("bioavailability", "").strip()
     ts_bioavailability = {}
     if len(ts_bioavailability_str):
-        matches = re.findall(
-            r"([a-zA-Z\/]+)[.:\s]+([0-9\.%\s\+/\-]+)", ts_bioavailability_str
-        )
+        matches = ts_bioavailability_re.findall(ts_bioavailability_str)
         if len(matches):
             for roa_name, value in matches:
                 ts_bioavailability[roa_name.lower()] = value.strip(". \t")
@@ -421,12 +573,8 @@ for name in all_substance_names:
     tolerance = pw_data.get("tolerance")
     cross_tolerances = pw_data.get("crossTolerances")
 
-    roas = []
-
-    # get PW ROAs
-    pw_roas = pw_substance.get("roas", [])
-
-    roas.extend(pw_roas)
+    # get PW ROAs, ignoring those without duration info
+    roas = [roa for roa in pw_substance.get("roas", []) if roa["duration"] is not None]
 
     interactions = None
     combos = ts_substance.get("combos")
@@ -436,19 +584,18 @@ for name in all_substance_names:
             if key in ts_combo_ignore:
                 continue
 
-            combo_data["name"] = ts_combo_transformations[key]
+            pretty_name = ts_combo_transformations.get(key)
+            if pretty_name is None:
+                # keep the interaction, but flag the category so a mapping gets added
+                if key not in ts_unknown_combos:
+                    ts_unknown_combos.add(key)
+                    print(f"No pretty name for TripSit combo {key}", file=sys.stderr)
+                pretty_name = key.title()
+
+            combo_data["name"] = pretty_name
             interactions.append(combo_data)
         interactions = sorted(interactions, key=lambda i: i["name"])
 
-    roaresult = []
-    for indexxi, roai in enumerate(roas):
-        if roai["duration"] is None:
-            continue
-        else:
-            roaresult.append(roai)
-
-    roas = roaresult
-
     ## Time to filter useless data
     if len(roas) < 1:
         continue
@@ -485,6 +632,5 @@ output_filename = f"substances_{time()}.json"
 if args.output and args.output.strip():
     output_filename = args.output.strip()
 
-substances_json = json.dumps(substance_data, indent=2)
-with open(output_filename, "w") as f:
-    f.write(substances_json)
+with open(output_filename, "wb") as f:
+    f.write(orjson.dumps(substance_data, option=orjson.OPT_INDENT_2))